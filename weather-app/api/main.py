@@ -1,43 +1,194 @@
 # api/main.py
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response
+from starlette.datastructures import MutableHeaders
 from pydantic import BaseModel
 import httpx
-from typing import Optional, Dict, List
+import orjson
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Awaitable, Callable, Optional, Dict, List, Tuple
 import asyncio
+import hashlib
 import time
 
-app = FastAPI(title="CosmoWeather API", version="1.1")
-
 GEOCODE_URL = "https://geocoding-api.open-meteo.com/v1/search"
 FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
 
+# Bundled coordinates for popular cities, keyed by lowercased name, so the most
+# common lookups skip the geocoding round-trip. Anything else falls back upstream.
+GAZETTEER: Dict[str, Dict] = orjson.loads(Path(__file__).with_name("gazetteer.json").read_bytes())
+
+# Most requests use the default hourly variables, so their parsed forms are built once here.
+_DEFAULT_HOURLY_TUPLE = ("temperature_2m", "relativehumidity_2m", "windspeed_10m")
+_DEFAULT_HOURLY_STR = ",".join(_DEFAULT_HOURLY_TUPLE)
+_DEFAULT_HOURLY_KEY = ",".join(sorted(_DEFAULT_HOURLY_TUPLE))
+# Forecast query parameters that never vary; copied per request.
+_FORECAST_STATIC_PARAMS = {"current_weather": True, "timezone": "auto", "forecast_days": 1}
+# Open-Meteo's grid is ~10 km, so coordinates are rounded to ~1 km before querying.
+# Nearby points then share one cache entry (here and at the upstream CDN).
+COORD_DECIMALS = 2
+
+# One pooled client shared by all requests so upstream connections are reused
+# instead of paying a fresh TCP+TLS handshake on every call. The lifespan owns it
+# as app.state.http; where lifespan doesn't run (serverless bridges, in-process
+# test clients) a fallback client is kept per event loop, since pooled
+# connections can only be used from the loop that opened them.
+_fallback_client: Optional[httpx.AsyncClient] = None
+_fallback_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _new_http_client() -> httpx.AsyncClient:
+    # Every request only talks to two Open-Meteo origins, so HTTP/2 lets
+    # geocoding and forecast calls multiplex over a couple of warm connections.
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100, keepalive_expiry=30.0),
+        timeout=10.0,
+        http2=True,
+    )
+
+
+async def get_http_client(request: Request) -> httpx.AsyncClient:
+    """FastAPI dependency returning the shared upstream client."""
+    client = getattr(request.app.state, "http", None)
+    if client is not None:
+        return client
+
+    global _fallback_client, _fallback_loop
+    loop = asyncio.get_running_loop()
+    if _fallback_client is None or _fallback_client.is_closed or _fallback_loop is not loop:
+        # A client left over from a finished loop can't be closed from this one;
+        # dropping it lets its sockets be collected.
+        _fallback_client = _new_http_client()
+        _fallback_loop = loop
+    return _fallback_client
+
+
+async def _prewarm(client: httpx.AsyncClient):
+    """Open connections to the upstream hosts so the first user request skips the TLS handshake."""
+    async def head(url: str):
+        try:
+            await client.head(url)
+        except httpx.HTTPError:
+            # Warming is best effort; real requests will surface upstream errors.
+            pass
+
+    await asyncio.gather(head(GEOCODE_URL), head(FORECAST_URL))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    client = _new_http_client()
+    app.state.http = client
+    await _prewarm(client)
+    try:
+        yield
+    finally:
+        del app.state.http
+        await client.aclose()
+
+
+app = FastAPI(
+    title="CosmoWeather API",
+    version="1.1",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+# Forecast payloads are several KB of JSON and compress well; clients that don't
+# send Accept-Encoding: gzip still get identity bodies.
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+
+
+class VaryAcceptEncodingMiddleware:
+    """Ensure every response carries exactly one Vary: Accept-Encoding.
+
+    GZipMiddleware only adds it to bodies it compresses, but shared caches need it
+    on the identity responses too. Added last so it wraps GZipMiddleware.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_vary(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                if "accept-encoding" not in headers.get("vary", "").lower():
+                    headers.add_vary_header("Accept-Encoding")
+            await send(message)
+
+        await self.app(scope, receive, send_with_vary)
+
+
+app.add_middleware(VaryAcceptEncodingMiddleware)
+
 # Simple in-memory TTL cache suitable for single-process serverless functions.
 # Note: serverless platforms may spin down and not preserve memory across invocations,
 # but this reduces upstream calls within a warm instance.
-_cache: Dict[str, Dict] = {}
-_cache_lock = asyncio.Lock()
+# TTLCache expires entries itself and evicts least-recently-used ones beyond
+# CACHE_MAX_ENTRIES, which keeps memory bounded under long-tailed traffic.
+# While the first caller is still fetching a value, its entry is the pending
+# asyncio.Future other callers await.
 CACHE_TTL_SECONDS = 300  # 5 minutes
+CACHE_MAX_ENTRIES = 10_000
+_cache = TTLCache(maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS, timer=time.monotonic)
+# Let browsers and CDNs reuse responses too. Suggestions change as the user types,
+# so they get a shorter lifetime.
+WEATHER_CACHE_CONTROL = f"public, max-age={CACHE_TTL_SECONDS}"
+AUTOCOMPLETE_CACHE_CONTROL = "public, max-age=60"
+
 
+# No lock needed: these run on the event loop without awaiting, so each
+# check-and-update is atomic with respect to other requests. Handlers call
+# cache_get directly so a hit never enters a coroutine.
+def cache_get(key: str):
+    value = _cache.get(key)
+    if isinstance(value, asyncio.Future):
+        return None
+    return value
 
-def _now():
-    return int(time.time())
 
+def cache_set(key: str, value):
+    _cache[key] = value
 
-async def cache_get(key: str):
-    async with _cache_lock:
-        entry = _cache.get(key)
-        if not entry:
-            return None
-        if entry["expires_at"] < _now():
-            # expired
-            del _cache[key]
-            return None
-        return entry["value"]
 
+def _settle(key: str, future: asyncio.Future):
+    # Only the entry we installed is replaced; a later cache_set wins.
+    if _cache.get(key) is not future:
+        return
+    if future.cancelled() or future.exception() is not None:
+        _cache.pop(key, None)
+    else:
+        cache_set(key, future.result())
 
-async def cache_set(key: str, value, ttl: int = CACHE_TTL_SECONDS):
-    async with _cache_lock:
-        _cache[key] = {"value": value, "expires_at": _now() + ttl}
+
+async def cache_get_or_fetch(key: str, fetch: Callable[[], Awaitable]):
+    """Return the cached value for `key`, calling `fetch()` on a miss.
+
+    Concurrent misses for the same key share a single in-flight fetch instead of
+    each hitting the upstream API.
+    """
+    entry = _cache.get(key)
+    # A pending fetch left behind by a loop that has since been torn down can
+    # never be awaited from this one; treat it as a miss and replace it.
+    if isinstance(entry, asyncio.Future) and entry.get_loop() is asyncio.get_running_loop():
+        future = entry
+    else:
+        value = cache_get(key)
+        if value is not None:
+            return value
+        # Run as its own task so a disconnecting caller does not cancel the
+        # fetch for everyone else waiting on it.
+        future = asyncio.ensure_future(fetch())
+        _cache[key] = future
+        future.add_done_callback(lambda f: _settle(key, f))
+    return await asyncio.shield(future)
 
 
 # Small mapping of Open-Meteo `weathercode` to description and emoji icon.
@@ -62,6 +213,20 @@ WEATHERCODE_MAP: Dict[int, Dict[str, str]] = {
     # Fallbacks will be handled in code.
 }
 
+# Dense tables indexed directly by weathercode (0-99), built from the map above.
+_WC_DESC = tuple(WEATHERCODE_MAP.get(code, {}).get("desc") for code in range(100))
+_WC_ICON = tuple(WEATHERCODE_MAP.get(code, {}).get("icon") for code in range(100))
+
+
+def describe_weathercode(wc) -> Tuple[str, str]:
+    """Map an Open-Meteo weathercode to a (description, icon) pair."""
+    # Upstream may send integral floats such as 3.0; they name the same code.
+    if isinstance(wc, float) and wc.is_integer():
+        wc = int(wc)
+    if isinstance(wc, int) and 0 <= wc < 100 and _WC_DESC[wc] is not None:
+        return _WC_DESC[wc], _WC_ICON[wc]
+    return ("Weather code " + str(wc) if wc is not None else ""), "🌈"
+
 
 class Location(BaseModel):
     name: str
@@ -80,45 +245,71 @@ class WeatherResponse(BaseModel):
 
 
 async def fetch_json(client: httpx.AsyncClient, url: str, params: dict):
-    resp = await client.get(url, params=params, timeout=10.0)
+    resp = await client.get(url, params=params)
     resp.raise_for_status()
-    return resp.json()
+    # httpx has already decompressed the body; orjson parses the float-heavy
+    # forecast payloads much faster than resp.json()'s stdlib decoder.
+    return orjson.loads(resp.content)
+
+
+# Geocoding fields exposed to the autocomplete UI. Optional ones such as admin1
+# may be missing upstream, hence .get() rather than itemgetter.
+_AUTOCOMPLETE_FIELDS = ("name", "country", "admin1", "latitude", "longitude")
 
 
 @app.get("/api/autocomplete")
-async def autocomplete(query: str = Query(..., min_length=1, description="Partial city name"), limit: int = 6):
+async def autocomplete(
+    query: str = Query(..., min_length=1, description="Partial city name"),
+    limit: int = 6,
+    client: httpx.AsyncClient = Depends(get_http_client),
+):
     """Return a small list of geocoding matches for autocomplete UI."""
     key = f"autocomplete:{query.lower()}:{limit}"
-    cached = await cache_get(key)
-    if cached is not None:
-        return cached
 
-    params = {"name": query, "count": limit, "language": "en", "format": "json"}
-    async with httpx.AsyncClient() as client:
+    async def fetch():
+        params = {"name": query, "count": limit, "language": "en", "format": "json"}
         geocode = await fetch_json(client, GEOCODE_URL, params)
         results = geocode.get("results", []) if geocode else []
-        simplified = []
-        for r in results:
-            simplified.append({
-                "name": r.get("name"),
-                "country": r.get("country"),
-                "admin1": r.get("admin1"),
-                "latitude": r.get("latitude"),
-                "longitude": r.get("longitude")
-            })
-        await cache_set(key, simplified)
-        return simplified
-
-
-@app.get("/api/weather", response_model=WeatherResponse)
+        return [{k: r.get(k) for k in _AUTOCOMPLETE_FIELDS} for r in results]
+
+    simplified = cache_get(key)
+    if simplified is None:
+        simplified = await cache_get_or_fetch(key, fetch)
+    return ORJSONResponse(
+        content=simplified,
+        headers={"Cache-Control": AUTOCOMPLETE_CACHE_CONTROL},
+    )
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against our ETag (RFC 9110)."""
+    if not if_none_match:
+        return False
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == opaque:
+            return True
+    return False
+
+
+# The body is built and serialized once per cache entry, so there's no
+# response_model re-validation; WeatherResponse still documents the schema.
+@app.get("/api/weather", responses={200: {"model": WeatherResponse}})
 async def get_weather(
+    request: Request,
     city: Optional[str] = Query(None, description="City name (use city or lat/lon)"),
     lat: Optional[float] = Query(None, description="Latitude (optional)"),
     lon: Optional[float] = Query(None, description="Longitude (optional)"),
     hourly_vars: Optional[str] = Query(
-        "temperature_2m,relativehumidity_2m,windspeed_10m",
+        _DEFAULT_HOURLY_STR,
         description="Comma separated hourly variables",
     ),
+    client: httpx.AsyncClient = Depends(get_http_client),
 ):
     """Get weather for a named city or lat/lon.
     If lat+lon provided, skip geocoding.
@@ -129,28 +320,31 @@ async def get_weather(
 
     # Determine coordinates
     if lat is not None and lon is not None:
+        lat = round(float(lat), COORD_DECIMALS)
+        lon = round(float(lon), COORD_DECIMALS)
         location = {
-            "name": city or f"{lat:.3f},{lon:.3f}",
-            "latitude": float(lat),
-            "longitude": float(lon),
+            "name": city or f"{lat:.{COORD_DECIMALS}f},{lon:.{COORD_DECIMALS}f}",
+            "latitude": lat,
+            "longitude": lon,
             "country": None,
             "admin1": None,
         }
     else:
-        # Use geocoding
-        geokey = f"geocode:{city.lower()}"
-        cached_geo = await cache_get(geokey)
-        if cached_geo is not None:
-            top = cached_geo
-        else:
-            async with httpx.AsyncClient() as client:
-                params = {"name": city, "count": 1, "language": "en", "format": "json"}
-                geocode = await fetch_json(client, GEOCODE_URL, params)
-                results = geocode.get("results", []) if geocode else []
-                if not results:
-                    raise HTTPException(status_code=404, detail=f"City '{city}' not found")
-                top = results[0]
-                await cache_set(geokey, top)
+        # Use geocoding; the gazetteer and the geocode cache share one normalized key.
+        city_key = city.strip().lower()
+        geokey = f"geocode:{city_key}"
+
+        async def fetch_geocode():
+            params = {"name": city, "count": 1, "language": "en", "format": "json"}
+            geocode = await fetch_json(client, GEOCODE_URL, params)
+            results = geocode.get("results", []) if geocode else []
+            if not results:
+                raise HTTPException(status_code=404, detail=f"City '{city}' not found")
+            return results[0]
+
+        top = GAZETTEER.get(city_key) or cache_get(geokey)
+        if top is None:
+            top = await cache_get_or_fetch(geokey, fetch_geocode)
 
         name = top.get("name") or city
         lat = top.get("latitude")
@@ -160,49 +354,65 @@ async def get_weather(
 
         location = {
             "name": name,
-            "latitude": float(lat),
-            "longitude": float(lon),
+            "latitude": round(float(lat), COORD_DECIMALS),
+            "longitude": round(float(lon), COORD_DECIMALS),
             "country": top.get("country"),
             "admin1": top.get("admin1"),
         }
 
     # Forecast params
-    hourly_list = [v.strip() for v in (hourly_vars or "").split(",") if v.strip()]
+    if hourly_vars == _DEFAULT_HOURLY_STR:
+        hourly_param = _DEFAULT_HOURLY_STR
+        hourly_key = _DEFAULT_HOURLY_KEY
+    else:
+        hourly_list = [v.strip() for v in (hourly_vars or "").split(",") if v.strip()]
+        hourly_param = ",".join(hourly_list)
+        hourly_key = ",".join(sorted(hourly_list))
     forecast_params = {
+        **_FORECAST_STATIC_PARAMS,
         "latitude": location["latitude"],
         "longitude": location["longitude"],
-        "current_weather": True,
-        "hourly": ",".join(hourly_list) if hourly_list else None,
-        "timezone": "auto",
-        "forecast_days": 1,
     }
-    forecast_params = {k: v for k, v in forecast_params.items() if v is not None}
+    if hourly_param:
+        forecast_params["hourly"] = hourly_param
 
-    cache_key = f"forecast:{location['latitude']:.4f},{location['longitude']:.4f}:{','.join(hourly_list)}"
-    cached_forecast = await cache_get(cache_key)
-    if cached_forecast is not None:
-        forecast = cached_forecast
-    else:
-        async with httpx.AsyncClient() as client:
-            forecast = await fetch_json(client, FORECAST_URL, forecast_params)
-            await cache_set(cache_key, forecast)
-
-    current = forecast.get("current_weather")
-    hourly = forecast.get("hourly", {})
-
-    if current is None:
-        raise HTTPException(status_code=502, detail="No current weather returned by upstream API")
-
-    # Map weathercode to description + icon
-    wc = current.get("weathercode")
-    wc_entry = WEATHERCODE_MAP.get(wc, None)
-    weather_desc = wc_entry["desc"] if wc_entry else ("Weather code " + str(wc) if wc is not None else "")
-    weather_icon = wc_entry["icon"] if wc_entry else "🌈"
-
-    return {
-        "location": location,
-        "current": current,
-        "hourly": hourly,
-        "weather_desc": weather_desc,
-        "weather_icon": weather_icon,
-    }
+    # One entry per location and variable set; the variables are sorted so
+    # "a,b" and "b,a" share it.
+    cache_key = (
+        f"weather:{location['name']}|{location['country']}|{location['admin1']}|"
+        f"{location['latitude']:.{COORD_DECIMALS}f},{location['longitude']:.{COORD_DECIMALS}f}:{hourly_key}"
+    )
+
+    async def build_body():
+        forecast = await fetch_json(client, FORECAST_URL, forecast_params)
+
+        current = forecast.get("current_weather")
+        hourly = forecast.get("hourly", {})
+
+        if current is None:
+            raise HTTPException(status_code=502, detail="No current weather returned by upstream API")
+
+        weather_desc, weather_icon = describe_weathercode(current.get("weathercode"))
+
+        body = orjson.dumps({
+            "location": location,
+            "current": current,
+            "hourly": hourly,
+            "weather_desc": weather_desc,
+            "weather_icon": weather_icon,
+        })
+        # Weak: GZipMiddleware may serve this as gzip or identity bytes.
+        etag = 'W/"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+        return body, etag
+
+    # Cache hits return the already-encoded bytes untouched.
+    cached = cache_get(cache_key)
+    if cached is None:
+        cached = await cache_get_or_fetch(cache_key, build_body)
+    body, etag = cached
+
+    headers = {"Cache-Control": WEATHER_CACHE_CONTROL, "ETag": etag}
+    # Polling clients that already hold this body only need a 304.
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
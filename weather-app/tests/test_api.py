@@ -1,3 +1,9 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
 import pytest
 from httpx import AsyncClient
 from api import main
@@ -26,4 +32,256 @@ async def test_weather_by_latlon():
     async with AsyncClient(app=main.app, base_url="http://test") as ac:
         # Use coordinates for New York City
         r = await ac.get("/api/weather", params={"lat":40.7128, "lon":-74.0060})
-        assert r.status_code in (200, 502)
\ No newline at end of file
+        assert r.status_code in (200, 502)
+
+
+FORECAST = {
+    "current_weather": {"temperature": 12.0, "windspeed": 3.0, "weathercode": 2},
+    "hourly": {"time": ["2024-01-01T00:00"], "temperature_2m": [12.0]},
+}
+
+
+class _ForecastHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so the client pools the connection on the loop that opened it.
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = json.dumps(FORECAST).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_http_client_survives_new_event_loop(monkeypatch):
+    # Serverless bridges and pytest-asyncio run each request on a fresh loop
+    # without lifespan; a pooled client from an earlier loop must not be reused.
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _ForecastHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(main, "FORECAST_URL", f"http://127.0.0.1:{server.server_port}/v1/forecast")
+    main._cache.clear()
+
+    async def get_status(lat):
+        async with AsyncClient(app=main.app, base_url="http://test") as ac:
+            r = await ac.get("/api/weather", params={"lat": lat, "lon": 0})
+            return r.status_code
+
+    try:
+        assert [asyncio.run(get_status(lat)) for lat in (1, 2, 3)] == [200, 200, 200]
+    finally:
+        server.shutdown()
+        server.server_close()
+        main._cache.clear()
+
+
+class FakeUpstream:
+    """Stands in for Open-Meteo via httpx.MockTransport and records every call."""
+
+    def __init__(self):
+        self.calls = []
+        self.requests = []
+        self.weathercode = 2
+        self.hourly = FORECAST["hourly"]
+        self.release = None  # set to an asyncio.Event to hold responses until released
+
+    async def __call__(self, request):
+        self.calls.append(request.url.host)
+        self.requests.append(request)
+        if self.release is not None:
+            await self.release.wait()
+        await asyncio.sleep(0.01)
+        if request.url.host == "geocoding-api.open-meteo.com":
+            if request.url.params["name"].lower() == "atlantis":
+                return httpx.Response(200, json={})
+            return httpx.Response(200, json={"results": [
+                {"name": "Springfield", "country": "United States", "admin1": "Illinois",
+                 "latitude": 39.80172, "longitude": -89.64371},
+            ]})
+        forecast = {
+            "current_weather": {**FORECAST["current_weather"], "weathercode": self.weathercode},
+            "hourly": self.hourly,
+        }
+        return httpx.Response(200, json=forecast)
+
+    def count(self, host):
+        return self.calls.count(host)
+
+
+GEOCODE_HOST = "geocoding-api.open-meteo.com"
+FORECAST_HOST = "api.open-meteo.com"
+
+
+@pytest.fixture
+def upstream():
+    fake = FakeUpstream()
+    main._cache.clear()
+    main.app.state.http = httpx.AsyncClient(transport=httpx.MockTransport(fake))
+    yield fake
+    del main.app.state.http
+    main._cache.clear()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_misses_share_one_upstream_call(upstream):
+    async with AsyncClient(app=main.app, base_url="http://test") as ac:
+        rs = await asyncio.gather(*[ac.get("/api/weather", params={"lat": 10, "lon": 20}) for _ in range(10)])
+    assert [r.status_code for r in rs] == [200] * 10
+    assert upstream.count(FORECAST_HOST) == 1
+
+
+@pytest.mark.asyncio
+async def test_failed_fetch_reaches_every_waiter_and_is_not_cached(upstream):
+    async with AsyncClient(app=main.app, base_url="http://test") as ac:
+        rs = await asyncio.gather(*[ac.get("/api/weather", params={"city": "Atlantis"}) for _ in range(5)])
+        assert [r.status_code for r in rs] == [404] * 5
+        assert upstream.count(GEOCODE_HOST) == 1
+
+        r = await ac.get("/api/weather", params={"city": "Atlantis"})
+        assert r.status_code == 404
+        assert upstream.count(GEOCODE_HOST) == 2
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_does_not_cancel_shared_fetch(upstream):
+    upstream.release = asyncio.Event()
+
+    def fetch():
+        return main.fetch_json(main.app.state.http, main.FORECAST_URL, {})
+
+    first = asyncio.create_task(main.cache_get_or_fetch("k", fetch))
+    second = asyncio.create_task(main.cache_get_or_fetch("k", fetch))
+    await asyncio.sleep(0)
+    first.cancel()
+    upstream.release.set()
+
+    assert (await second)["current_weather"]["weathercode"] == 2
+    assert first.cancelled()
+    assert upstream.count(FORECAST_HOST) == 1
+    assert main.cache_get("k") is not None
+
+
+def test_pending_fetch_from_closed_loop_is_ignored():
+    main._cache.clear()
+
+    async def start_fetch():
+        # Leave the fetch pending when this loop stops.
+        asyncio.ensure_future(main.cache_get_or_fetch("k", lambda: asyncio.sleep(3600)))
+        await asyncio.sleep(0)
+
+    old_loop = asyncio.new_event_loop()
+    old_loop.run_until_complete(start_fetch())
+    old_loop.close()
+
+    async def fresh():
+        return "fresh"
+
+    try:
+        assert asyncio.run(main.cache_get_or_fetch("k", fresh)) == "fresh"
+        assert main.cache_get("k") == "fresh"
+    finally:
+        main._cache.clear()
+
+
+@pytest.mark.asyncio
+async def test_matching_etag_returns_304(upstream):
+    async with AsyncClient(app=main.app, base_url="http://test") as ac:
+        r = await ac.get("/api/weather", params={"lat": 10, "lon": 20})
+        assert r.status_code == 200
+        etag = r.headers["etag"]
+        assert etag.startswith('W/"')
+
+        for if_none_match in (etag, f'"other", {etag[2:]}', "*"):
+            r = await ac.get("/api/weather", params={"lat": 10, "lon": 20},
+                             headers={"if-none-match": if_none_match})
+            assert r.status_code == 304
+            assert r.content == b""
+            assert r.headers["etag"] == etag
+
+        r = await ac.get("/api/weather", params={"lat": 10, "lon": 20}, headers={"if-none-match": '"other"'})
+        assert r.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_cache_headers(upstream):
+    async with AsyncClient(app=main.app, base_url="http://test") as ac:
+        r = await ac.get("/api/weather", params={"lat": 10, "lon": 20})
+        assert r.headers["cache-control"] == "public, max-age=300"
+        assert r.headers["vary"] == "Accept-Encoding"
+
+        r = await ac.get("/api/autocomplete", params={"query": "Spring"})
+        assert r.headers["cache-control"] == "public, max-age=60"
+        assert r.headers["vary"] == "Accept-Encoding"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("accept_encoding, content_encoding", [("gzip", "gzip"), ("identity", None)])
+async def test_vary_header_is_not_duplicated(upstream, accept_encoding, content_encoding):
+    # Large enough for GZipMiddleware's minimum_size, so the gzip path really compresses.
+    upstream.hourly = {
+        "time": [f"2024-01-01T{h:02d}:00" for h in range(24)],
+        "temperature_2m": [12.5] * 24,
+        "relativehumidity_2m": [81] * 24,
+        "windspeed_10m": [3.25] * 24,
+    }
+    async with AsyncClient(app=main.app, base_url="http://test") as ac:
+        r = await ac.get("/api/weather", params={"lat": 10, "lon": 20},
+                         headers={"accept-encoding": accept_encoding})
+    assert r.status_code == 200
+    assert len(r.content) > 1000
+    assert r.headers.get("content-encoding") == content_encoding
+    assert r.headers["vary"] == "Accept-Encoding"
+
+
+@pytest.mark.asyncio
+async def test_gazetteer_city_skips_geocoding(upstream):
+    async with AsyncClient(app=main.app, base_url="http://test") as ac:
+        r = await ac.get("/api/weather", params={"city": " London "})
+        assert r.status_code == 200
+        assert r.json()["location"]["country"] == "United Kingdom"
+        assert upstream.calls == [FORECAST_HOST]
+
+        r = await ac.get("/api/weather", params={"city": "Springfield"})
+        assert r.status_code == 200
+        assert upstream.count(GEOCODE_HOST) == 1
+
+
+@pytest.mark.parametrize("code, expected", [
+    (3, ("Overcast", "☁️")),
+    (3.0, ("Overcast", "☁️")),
+    (4, ("Weather code 4", "🌈")),
+    (150, ("Weather code 150", "🌈")),
+    (-1, ("Weather code -1", "🌈")),
+    (None, ("", "🌈")),
+])
+def test_describe_weathercode(code, expected):
+    assert main.describe_weathercode(code) == expected
+
+
+@pytest.mark.asyncio
+async def test_hourly_var_order_shares_cache_entry(upstream):
+    async with AsyncClient(app=main.app, base_url="http://test") as ac:
+        r1 = await ac.get("/api/weather", params={"lat": 10, "lon": 20, "hourly_vars": "windspeed_10m,temperature_2m"})
+        r2 = await ac.get("/api/weather", params={"lat": 10, "lon": 20, "hourly_vars": "temperature_2m,windspeed_10m"})
+    assert r1.status_code == r2.status_code == 200
+    assert upstream.count(FORECAST_HOST) == 1
+    # Only the cache key is canonicalized; upstream sees the caller's order.
+    assert upstream.requests[0].url.params["hourly"] == "windspeed_10m,temperature_2m"
+
+
+@pytest.mark.asyncio
+async def test_nearby_coordinates_share_rounded_forecast(upstream):
+    async with AsyncClient(app=main.app, base_url="http://test") as ac:
+        r1 = await ac.get("/api/weather", params={"lat": 10.001, "lon": 20.004})
+        r2 = await ac.get("/api/weather", params={"lat": 10.004, "lon": 19.996})
+    assert r1.status_code == r2.status_code == 200
+    assert upstream.count(FORECAST_HOST) == 1
+    params = upstream.requests[0].url.params
+    assert (params["latitude"], params["longitude"]) == ("10.0", "20.0")
+    for r in (r1, r2):
+        location = r.json()["location"]
+        assert (location["latitude"], location["longitude"]) == (10.0, 20.0)
+        assert location["name"] == "10.00,20.00"